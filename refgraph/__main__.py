@@ -1,11 +1,24 @@
 """
 Entry point
 """
+
 __docformat__ = "google"
 
-from dataclasses import dataclass
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
 from pathlib import Path
-from typing import List, Optional, Tuple
+from typing import (
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Match,
+    Optional,
+    Set,
+    Tuple,
+)
 import re
 import sys
 
@@ -16,7 +29,6 @@ from pylatexenc.latexwalker import (
     LatexWalker,
 )
 import click
-import graphviz
 
 try:
     # pylint: disable=redefined-builtin
@@ -25,84 +37,90 @@ except ImportError:
     pass
 
 
-REFERENCE_MACROS = ["cref", "eqref", "ref", "vref"]
-MAIN_ENVIRONMENTS = [
+CHUNK_SIZE = 1 << 20
+"""Number of characters read at once by `parse_file`"""
+
+REFERENCE_MACROS = frozenset(["cref", "eqref", "ref", "vref"])
+_MAIN_ENVIRONMENT_BASES = [
     "assertion",
-    "assertion*",
-    "assertions",
-    "assertions*",
     "axiom",
-    "axiom*",
-    "axioms",
-    "axioms*",
     "conjecture",
-    "conjecture*",
-    "conjectures",
-    "conjectures*",
     "convention",
-    "convention*",
-    "conventions",
-    "conventions*",
-    "corollaries",
-    "corollaries*",
     "corollary",
-    "corollary*",
     "definition",
-    "definition*",
-    "definitions",
-    "definitions*",
     "example",
-    "example*",
-    "examples",
-    "examples*",
     "exercise",
-    "exercise*",
-    "exercises",
-    "exercises*",
     "lemma",
-    "lemma*",
-    "lemmas",
-    "lemmas*",
     "notation",
-    "notation*",
-    "notations",
-    "notations*",
-    "properties",
-    "properties*",
     "property",
-    "property*",
     "proposition",
-    "proposition*",
-    "propositions",
-    "propositions*",
     "question",
-    "question*",
-    "questions",
-    "questions*",
     "remark",
-    "remark*",
-    "remarks",
-    "remarks*",
     "reminder",
-    "reminder*",
-    "reminders",
-    "reminders*",
     "scholia",
-    "scholia*",
-    "scholias",
-    "scholias*",
-    "terminologies",
-    "terminologies*",
     "terminology",
-    "terminology*",
     "theorem",
-    "theorem*",
-    "theorems",
-    "theorems*",
 ]
+_IRREGULAR_PLURALS = {
+    "corollary": "corollaries",
+    "property": "properties",
+    "terminology": "terminologies",
+}
+MAIN_ENVIRONMENTS = frozenset(
+    name + star
+    for base in _MAIN_ENVIRONMENT_BASES
+    for name in (base, _IRREGULAR_PLURALS.get(base, base + "s"))
+    for star in ("", "*")
+)
+SKIP_ENVIRONMENTS = frozenset(
+    [
+        "comment",
+        "lstlisting",
+        "minted",
+        "tikzpicture",
+        "verbatim",
+        "verbatim*",
+    ]
+)
 
+# Matches either an escaped character (e.g. \% or \\), a comment, or a whole
+# environment of SKIP_ENVIRONMENTS, which are then ignored, or a \label,
+# \begin, \end, or reference macro together with its (braced) argument. The
+# argument may contain comments (e.g. \cref{a,%<newline>b}), which are stripped
+# with `strip_comments`.
+# Escaped characters are matched as tokens of their own so that e.g. \\%
+# starts a comment while \% doesn't, and \\ref is not taken for a reference.
+# The contents of skipped environments are not tokenized at all, so that e.g.
+# a % in a verbatim environment doesn't hide its \end. Reference macros are
+# matched case insensitively, like in `get_references`.
+_SKIPPED_RE = "|".join(re.escape(e) for e in sorted(SKIP_ENVIRONMENTS))
+_MACRO_RE = r"label|begin|end|(?i:" + "|".join(sorted(REFERENCE_MACROS)) + r")"
+_ARGUMENT_RE = r"(?:[^}%\\]|\\[\s\S]|%[^\n]*\n)*"
+SCAN_RE = re.compile(
+    r"\\[^A-Za-z]"
+    r"|%[^\n]*"
+    r"|\\begin\s*\{(?P<skipped>" + _SKIPPED_RE + r")\}"
+    r"[\s\S]*?\\end\s*\{(?P=skipped)\}"
+    r"|\\(?P<macro>" + _MACRO_RE + r")\*?\s*"
+    r"\{(?P<argument>" + _ARGUMENT_RE + r")\}"
+)
+# Matches text that runs until the end of the string, and could be the
+# beginning of a match of SCAN_RE that would need more text to complete (a
+# comment, a macro name, a macro argument, or a skipped environment that is
+# not ended yet). This overapproximates, e.g. with any trailing macro name.
+PARTIAL_RE = re.compile(
+    r"(?:%[^\n]*"
+    r"|\\begin\s*\{(?P<skipped>" + _SKIPPED_RE + r")\}"
+    r"(?:(?!\\end\s*\{(?P=skipped)\})[\s\S])*"
+    r"|\\[A-Za-z]*"
+    r"|\\(?:" + _MACRO_RE + r")\*?\s*"
+    r"(?:\{" + _ARGUMENT_RE + r"(?:%[^\n]*|\\)?)?"
+    r")\Z"
+)
+COMMENT_RE = re.compile(r"(\\[\s\S])|%[^\n]*")
 
-@dataclass
+
+@dataclass(frozen=True)
 class Reference:
     """
     A reference is given by the following data:
@@ -111,67 +129,308 @@ class Reference:
     * `to` the label being referenced.
     """
 
+    __slots__ = ("from_", "to")
+
     from_: Optional[str]
     to: str
 
-    def __hash__(self) -> int:
-        return hash(str(self.from_) + "\\" + self.to)
+    def __reduce__(self) -> Tuple[type, Tuple[Optional[str], str]]:
+        # With hand-written __slots__, the default pickling restores the
+        # fields by setting attributes on a blank instance, which frozen=True
+        # forbids (only dataclass(slots=True) generates the __getstate__ and
+        # __setstate__ that avoid this). Rebuild through the constructor
+        # instead.
+        return (Reference, (self.from_, self.to))
+
+
+def escape_dot(string: str) -> str:
+    """Escapes a string so that it can be used in a quoted DOT identifier."""
+    return string.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def get_dot_body(references: Iterable[Reference]) -> List[str]:
+    """
+    Produces the DOT statements (nodes and edges) of the reference graph.
+    These are meant to be added to the body of a `graphviz.Digraph` in one go,
+    which is much faster than going through `graphviz.Digraph.node` and
+    `graphviz.Digraph.edge` for every reference. References without a `from_`
+    label are ignored. Every node is declared exactly once, and identified by
+    a small integer.
+    """
+    body: List[str] = []
+    node_ids: Dict[str, str] = {}
+
+    def node_id(label: str) -> str:
+        """
+        Returns the identifier of the node of a label, declaring it if needed.
+        """
+        i = node_ids.get(label)
+        if i is None:
+            i = node_ids[label] = str(len(node_ids))
+            body.append(f'\t{i} [label="{escape_dot(label)}"]\n')
+        return i
+
+    for r in references:
+        if not r.from_:
+            continue
+        a, b = node_id(r.from_), node_id(r.to)
+        body.append(f"\t{a} -> {b}\n")
+    return body
+
+
+@dataclass
+class _Environment:
+    """
+    State of an environment (or of the whole document) in `scan_references`.
+    """
 
-    def add_edge_to_graph(self, graph: graphviz.Digraph) -> None:
-        """Adds this reference as an edge to a graph."""
-        if not self.from_:
-            return
-        a = str(hash(self.from_))
-        b = str(hash(self.to))
-        graph.node(a, self.from_)
-        graph.node(b, self.to)
-        graph.edge(a, b)
+    name: Optional[str]
+    label: Optional[str]
+    last_label: Optional[str] = None
+    targets: List[str] = field(default_factory=list)
 
 
-def get_references(
+def get_label(nodes: List[LatexNode]) -> Optional[str]:
+    """
+    Returns the argument of the first `\\label` macro found (non-recursively)
+    in a list of `LatexNode`s, or `None` if there are none.
+    """
+    for node in nodes:
+        # pylint: disable=unidiomatic-typecheck
+        if type(node) is LatexMacroNode and node.macroname == "label":
+            label = get_macro_argument(node)
+            if label is not None:
+                return sys.intern(label)
+    return None
+
+
+def get_macro_argument(node: LatexMacroNode) -> Optional[str]:
+    """
+    Returns the text of the first argument of a macro node, or `None` if it
+    doesn't have one, or if it is not a braced group (e.g. `\\ref x`).
+    """
+    argd = node.nodeargd
+    if argd is None or not argd.argnlist:
+        return None
+    nodelist = getattr(argd.argnlist[0], "nodelist", None)
+    if not nodelist:
+        return None
+    return getattr(nodelist[0], "chars", None)
+
+
+def get_references(  # pylint: disable=too-many-locals
     nodes: List[LatexNode],
     label: Optional[str] = None,
-) -> Tuple[Optional[str], List[Reference]]:
+    references: Optional[Set[Reference]] = None,
+) -> Tuple[Optional[str], Set[Reference]]:
     """
-    Produces a list of references (from/to pairs) from a list of `LatexNode`s.
+    Produces a set of references (from/to pairs) from a list of `LatexNode`s.
+    The node tree is walked iteratively, so arbitrarily deep documents do not
+    hit the recursion limit.
 
     Args:
         nodes: List of `LatexNode`s
         label: Optional override for the overarching label for this list of
             nodes. In other words, any "orphan" \ref found in this list will be
             parented to this label.
+        references: Optional set in which to accumulate the references. If
+            left to `None`, a new set is created.
 
     Returns:
-        The found overarching label for this list of nodes, with the list of references.
+        The found overarching label for this list of nodes, with the set of
+        references.
     """
-    references: List[Reference] = []
-    last_label: Optional[str] = None
-    for node in nodes:
-        if isinstance(node, LatexMacroNode):
-            if node.macroname == "label" and label is None:
-                label = node.nodeargd.argnlist[0].nodelist[0].chars
-            elif str(node.macroname).lower() in REFERENCE_MACROS:
-                r = node.nodeargd.argnlist[0].nodelist[0].chars
-                references += [
-                    Reference(None, l) for l in re.split(r",\s*", r)
-                ]
-        if isinstance(node, LatexEnvironmentNode):
-            if node.environmentname in MAIN_ENVIRONMENTS:
-                last_label, environment_references = get_references(
-                    nodes=node.nodelist,
-                )
-            else:
-                _, environment_references = get_references(
-                    nodes=node.nodelist,
-                    label=last_label,
-                )
-            references += environment_references
-    for r in references:
-        if not r.from_:
-            r.from_ = label
+    if references is None:
+        references = set()
+    if label is None:
+        label = get_label(nodes)
+    # Bind globals and methods used in the loop below to locals, which are
+    # faster to look up
+    macro_node, environment_node = LatexMacroNode, LatexEnvironmentNode
+    reference_macros = REFERENCE_MACROS
+    main_environments = MAIN_ENVIRONMENTS
+    skip_environments = SKIP_ENVIRONMENTS
+    reference = Reference
+    macro_argument = get_macro_argument
+    update = references.update
+    intern = sys.intern
+    # Node lists left to process, with the label their orphan references are
+    # parented to. References are collected in a set, so the order in which
+    # node lists are processed does not matter.
+    stack: List[Tuple[List[LatexNode], Optional[str]]] = [(nodes, label)]
+    while stack:
+        node_list, from_ = stack.pop()
+        last_label: Optional[str] = None
+        for node in node_list:
+            # pylatexenc's node classes are never subclassed, so exact type
+            # comparisons are safe, and cheaper than isinstance
+            t = type(node)
+            if t is macro_node:
+                if node.macroname.lower() in reference_macros:
+                    r = macro_argument(node)
+                    if r is None:
+                        continue
+                    update(
+                        reference(from_, intern(l.strip()))
+                        for l in r.split(",")
+                    )
+            elif t is environment_node:
+                name = node.environmentname
+                if name in skip_environments:
+                    continue
+                if name in main_environments:
+                    last_label = environment_label = get_label(node.nodelist)
+                elif last_label is not None:
+                    environment_label = last_label
+                else:
+                    environment_label = get_label(node.nodelist)
+                stack.append((node.nodelist, environment_label or from_))
     return label, references
 
 
+def scan_chunks(chunks: Iterable[str]) -> Iterator[Match]:
+    """
+    Finds the matches of `SCAN_RE` in LaTeX source code given as consecutive
+    chunks of text, including matches that straddle two chunks.
+
+    Each chunk (prepended with what was carried over from the previous one) is
+    scanned, and everything from the first position where a match could be
+    incomplete is carried over to the next chunk, and scanned again there.
+    Such positions are those where `PARTIAL_RE` matches, except inside
+    matches of `SCAN_RE`, since the scanner never starts a match there.
+    """
+    carry = ""
+    for chunk in chunks:
+        data = carry + chunk
+        matches = list(SCAN_RE.finditer(data))
+        starts = [m.start() for m in matches]
+        cut, candidate = len(data), PARTIAL_RE.search(data)
+        while candidate is not None:
+            i = bisect_right(starts, candidate.start()) - 1
+            if i >= 0 and starts[i] < candidate.start() < matches[i].end():
+                candidate = PARTIAL_RE.search(data, matches[i].end())
+            else:
+                cut, candidate = candidate.start(), None
+        yield from matches[: bisect_left(starts, cut)]
+        carry = data[cut:]
+    yield from SCAN_RE.finditer(carry)
+
+
+def strip_comments(text: str) -> str:
+    """Removes the LaTeX comments from a piece of source code."""
+    if "%" not in text:
+        return text
+    return COMMENT_RE.sub(r"\1", text)
+
+
+def scan_references(
+    chunks: Iterable[str],
+) -> Set[Reference]:
+    r"""
+    Produces a set of references (from/to pairs) from LaTeX source code, by
+    scanning it for `\label`s, reference macros, and environment delimiters.
+    This is much faster than building the syntax tree of the document with
+    `pylatexenc` and going through `get_references`. Labels are attributed to
+    environments with the same rules, but the scanner doesn't know about
+    groups, macro arguments, or math. Therefore, unlike `get_references`, it
+    also finds references inside them (e.g. `\textbf{\ref{a}}`,
+    `\footnote{\cref{b}}`, or `$\eqref{c}$`), and a `\label` inside a macro
+    argument (e.g. `\caption{...\label{d}}`) can be taken as the label of
+    the enclosing environment. The resulting graph can thus differ from the
+    one obtained with `pylatexenc`.
+
+    Args:
+        chunks: The source code, as consecutive chunks of text (e.g.
+            `[source]` if it is already fully in memory). The whole source
+            never needs to be held in memory at once.
+
+    Example:
+        The result does not depend on how the source is split, even within
+        a macro argument. Here, a string is passed as chunks of one
+        character:
+
+        >>> source = "\\cref{eq\\_1, eq:2} text\\\\ % \\ref{x}\n"
+        >>> scan_references(source) == scan_references([source])
+        True
+
+        Or, as two chunks splitting an argument right after a comment:
+
+        >>> source = "\\label{t}\n\\cref{a,%\n b}\n"
+        >>> sorted(r.to for r in scan_references([source[:19], source[19:]]))
+        ['a', 'b']
+    """
+    references: Set[Reference] = set()
+    stack = [_Environment(None, None)]
+
+    def close(environment: _Environment, parent: _Environment) -> None:
+        """
+        Parents the references of an environment that has ended. If the
+        environment has no label, its references are handed over to its
+        parent.
+        """
+        if environment.label:
+            references.update(
+                Reference(environment.label, t) for t in environment.targets
+            )
+        else:
+            parent.targets += environment.targets
+        if environment.name in MAIN_ENVIRONMENTS:
+            parent.last_label = environment.label
+
+    for match in scan_chunks(chunks):
+        macro, argument = match.group("macro", "argument")
+        if macro is None:  # Escaped character, comment, or skipped environment
+            continue
+        current = stack[-1]
+        if macro == "begin":
+            if argument in SKIP_ENVIRONMENTS:  # Never ended
+                break
+            if argument in MAIN_ENVIRONMENTS:
+                stack.append(_Environment(argument, None))
+            else:
+                stack.append(_Environment(argument, current.last_label))
+        elif macro == "end":
+            if len(stack) > 1:
+                stack.pop()
+                close(current, stack[-1])
+        elif macro == "label":
+            label = strip_comments(argument).strip()
+            if current.label is None and label:
+                current.label = sys.intern(label)
+        else:
+            targets = (t.strip() for t in strip_comments(argument).split(","))
+            current.targets += [sys.intern(t) for t in targets if t]
+    while len(stack) > 1:  # Unclosed environments
+        environment = stack.pop()
+        close(environment, stack[-1])
+    references.update(Reference(stack[0].label, t) for t in stack[0].targets)
+    return references
+
+
+def parse_file(
+    file_path: Path, use_pylatexenc: bool = False
+) -> Set[Reference]:
+    """
+    Reads and parses a LaTeX file, and returns the references it contains.
+
+    Args:
+        file_path: Path to the LaTeX file
+        use_pylatexenc: If `True`, the file is parsed with `pylatexenc` and
+            `get_references`, which is slower but copes with more complex
+            syntax, and ignores references inside groups, macro arguments and
+            math. Otherwise, the file is streamed through `scan_references`
+            in chunks of `CHUNK_SIZE` characters.
+    """
+    print(f"Reading file {file_path}")
+    if not use_pylatexenc:
+        with open(file_path, "r", encoding="utf-8") as f:
+            return scan_references(iter(partial(f.read, CHUNK_SIZE), ""))
+    walker = LatexWalker(file_path.read_text(encoding="utf-8"))
+    nodelist, *_ = walker.get_latex_nodes(pos=0)
+    _, references = get_references(nodelist)
+    return references
+
+
 @click.command()
 @click.argument(
     "FILES",
@@ -198,29 +457,67 @@ def get_references(
         writable=True,
     ),
 )
-def main(files: Tuple[Path], output_directory: Path):
+@click.option(
+    "--pygraphviz/--no-pygraphviz",
+    "use_pygraphviz",
+    default=True,
+    help=(
+        "Lay out and render the graph in-process with pygraphviz, if it is "
+        "installed, instead of calling the dot executable."
+    ),
+)
+@click.option(
+    "--pylatexenc/--no-pylatexenc",
+    "use_pylatexenc",
+    default=False,
+    help=(
+        "Parse the source files with pylatexenc instead of the built-in "
+        "scanner. This is slower, but copes with more complex syntax. Note "
+        "that unlike the scanner, pylatexenc ignores references and labels "
+        "inside groups, macro arguments (e.g. \\footnote or \\caption), and "
+        "math, so the two can produce different graphs."
+    ),
+)
+def main(
+    files: Tuple[Path],
+    output_directory: Path,
+    use_pygraphviz: bool,
+    use_pylatexenc: bool,
+):
     """Entrypoint."""
     if not files:
         print("ERROR: Must specify at least one source file.")
         sys.exit(-1)
 
-    all_references: List[Reference] = []
-    for file_path in files:
-        print(f"Reading file {file_path}")
-        with open(file_path, "r", encoding="utf-8") as f:
-            walker = LatexWalker(f.read())
-        nodelist, *_ = walker.get_latex_nodes(pos=0)
-        _, references = get_references(nodelist)
-        all_references += references
+    all_references: Set[Reference] = set()
+    with ProcessPoolExecutor() as executor:
+        parse = partial(parse_file, use_pylatexenc=use_pylatexenc)
+        for references in executor.map(parse, files):
+            all_references.update(references)
+
+    # graphviz is only needed here, so it is imported lazily to keep importing
+    # this module (e.g. to use get_references) cheap
+    # pylint: disable=import-outside-toplevel
+    import graphviz
 
     graph = graphviz.Digraph()
     graph.attr("node", shape="box")
-    for r in set(all_references):
-        r.add_edge_to_graph(graph)
+    graph.body.extend(get_dot_body(all_references))
 
     print(f"Rendering graph to {str(output_directory)}")
-    graph.render(output_directory / "graph.gv")
+    if use_pygraphviz:
+        try:
+            import pygraphviz
+        except ImportError:
+            use_pygraphviz = False
+    if use_pygraphviz:
+        agraph = pygraphviz.AGraph(string=graph.source)
+        agraph.write(str(output_directory / "graph.gv"))
+        agraph.draw(str(output_directory / "graph.gv.pdf"), prog="dot")
+    else:
+        graph.render(output_directory / "graph.gv")
 
 
-# pylint: disable=no-value-for-parameter
-main()
+if __name__ == "__main__":
+    # pylint: disable=no-value-for-parameter
+    main()